@@ -53,7 +53,7 @@ def overview_all():
 					lexicon_names.append((entry.name, msg))
 	# Print the results
 	if len(lexicon_names) > 0:
-		l = max([len(name) for name, msg in lexicon_names]) + 4
+		l = max(len(name) for name, msg in lexicon_names) + 4
 		print("Lexicons:")
 		for name, msg in sorted(lexicon_names):
 			print("  {}{}{}".format(name, " " * (l - len(name)), msg))
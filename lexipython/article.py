@@ -1,8 +1,16 @@
 import os
 import sys
 import re
+from operator import attrgetter
 import utils
 
+# Source file headers, in the order they must appear
+SOURCE_HEADERS = (
+	("Player", "# Player:"),
+	("Turn", "# Turn:"),
+	("Title", "# Title:"),
+)
+
 class LexiconCitation:
 	"""
 	Represents information about a single citation in a Lexicon article.
@@ -38,8 +46,10 @@ class LexiconArticle:
 	turn            integer: turn the article was written for
 	title           string: article title
 	title_filesafe  string: title, escaped, used for filenames
+	title_sort      string: title, reduced for sorting
 	content         string: HTML content, with citations replaced by format hooks
 	citations       list of LexiconCitations: citations made by the article
+	word_count      integer: number of words in the article as written
 	link_class      string: CSS class to interpolate (for styling phantoms)
 
 	Members undefined until interlink:
@@ -57,8 +67,14 @@ class LexiconArticle:
 		self.turn = turn
 		self.title = title
 		self.title_filesafe = utils.titleescape(title)
+		self.title_sort = utils.titlesort(title)
 		self.content = content
 		self.citations = citations
+		# Write the citation aliases back in to count words as written
+		plain_content = content.format_map({
+			"c{}".format(c.id): c.text
+			for c in citations})
+		self.word_count = len(plain_content.split())
 		self.link_class = "class=\"phantom\"" if player is None else ""
 		self.addendums = []
 		self.citedby = set()
@@ -77,34 +93,30 @@ class LexiconArticle:
 		Parses the contents of a Lexipython source file into a LexiconArticle
 		object. If the source file is malformed, returns None.
 		"""
-		headers = raw_content.split('\n', 3)
-		if len(headers) != 4:
+		headers = raw_content.split('\n', len(SOURCE_HEADERS))
+		if len(headers) != len(SOURCE_HEADERS) + 1:
 			print("Header read error")
 			return None
-		player_header, turn_header, title_header, content_raw = headers
-		# Validate and sanitize the player header
-		if not player_header.startswith("# Player:"):
-			print("Player header missing or corrupted")
-			return None
-		player = player_header[9:].strip()
-		# Validate and sanitize the turn header
-		if not turn_header.startswith("# Turn:"):
-			print("Turn header missing or corrupted")
-			return None
-		turn = None
+		*header_lines, content_raw = headers
+		# Validate each header and strip its prefix
+		header_values = []
+		for (header_name, prefix), line in zip(SOURCE_HEADERS, header_lines):
+			if not line.startswith(prefix):
+				print("{} header missing or corrupted".format(header_name))
+				return None
+			header_values.append(line[len(prefix):])
+		player_value, turn_value, title_value = header_values
+		player = player_value.strip()
+		# int() ignores surrounding whitespace on its own
 		try:
-			turn = int(turn_header[7:].strip())
-		except:
+			turn = int(turn_value)
+		except ValueError:
 			print("Turn header error")
 			return None
-		# Validate and sanitize the title header
-		if not title_header.startswith("# Title:"):
-			print("Title header missing or corrupted")
-			return None
-		title = utils.titlecase(title_header[8:])
+		title = utils.titlecase(title_value)
 		# Parse the content and extract citations
 		paras = re.split("\n\n+", content_raw.strip())
-		content = ""
+		content_parts = []
 		citations = []
 		format_id = 1
 		if not paras:
@@ -131,7 +143,7 @@ class LexiconArticle:
 				cite = LexiconCitation(format_id, cite_text, cite_title)
 				citations.append(cite)
 				# Stitch the format id in place of the citation
-				para = para[:link_match.start(0)] + "{c"+str(format_id)+"}" + para[link_match.end(0):]
+				para = para[:link_match.start(0)] + "{{c{}}}".format(format_id) + para[link_match.end(0):]
 				format_id += 1 # Increment to the next format citation
 				link_match = re.search(r"\[\[(([^|\[\]]+)\|)?([^|\[\]]+)\]\]", para)
 			# Convert signature to right-aligned
@@ -139,7 +151,8 @@ class LexiconArticle:
 				para = "<hr><span class=\"signature\"><p>" + para[1:] + "</p></span>\n"
 			else:
 				para = "<p>" + para + "</p>\n"
-			content += para
+			content_parts.append(para)
+		content = "".join(content_parts)
 		return LexiconArticle(player, turn, title, content, citations)
 
 	@staticmethod
@@ -151,13 +164,13 @@ class LexiconArticle:
 		"""
 		articles = []
 		print("Reading source files from", directory)
-		for filename in os.listdir(directory):
-			path = os.path.join(directory, filename)
-			# Read only .txt files
-			if filename[-4:] == ".txt":
-				print("    Parsing", filename)
-				with open(path, "r", encoding="utf8") as src_file:
-					raw = src_file.read()
+		with os.scandir(directory) as entries:
+			for entry in entries:
+				# Read only .txt files
+				if entry.name.endswith(".txt") and entry.is_file():
+					print("    Parsing", entry.name)
+					with open(entry.path, "r", encoding="utf8") as src_file:
+						raw = src_file.read()
 					article = LexiconArticle.from_file_raw(raw)
 					if article is None:
 						print("        ERROR")
@@ -170,7 +183,8 @@ class LexiconArticle:
 	def interlink(lexicon_articles, config):
 		"""
 		Fills out fields on articles that require other articles for context.
-		Creates phantom articles.
+		Creates phantom articles. Returns all articles, including phantoms,
+		sorted by turn and then title.
 		"""
 		# Preliminary assertion that title/turn is unique
 		keys = set()
@@ -190,7 +204,7 @@ class LexiconArticle:
 		written_titles = set()
 		cited_titles = set()
 		article_by_title = {}
-		written_articles_ordered = sorted(lexicon_articles, key=lambda a: (a.turn, a.title))
+		written_articles_ordered = sorted(lexicon_articles, key=attrgetter("turn", "title"))
 		for written_article in written_articles_ordered:
 			# Track main articles by title
 			if written_article.title not in written_titles:
@@ -219,7 +233,7 @@ class LexiconArticle:
 					citation.article = target_article
 					target_article.citedby.add(citing_article)
 		# Sort the articles by turn and title, then fill in prev/next fields
-		articles_ordered = sorted(article_by_title.values(), key=lambda a: (a.turn, utils.titlesort(a.title)))
+		articles_ordered = sorted(article_by_title.values(), key=attrgetter("turn", "title_sort"))
 		for i in range(len(articles_ordered)):
 			articles_ordered[i].prev_article = articles_ordered[i-1] if i != 0 else None
 			articles_ordered[i].next_article = articles_ordered[i+1] if i != len(articles_ordered)-1 else None
@@ -229,42 +243,42 @@ class LexiconArticle:
 		"""
 		Builds the contents of the content div for an article page.
 		"""
-		content = ""
+		parts = []
 		# Build the main article content block
 		main_body = self.build_default_article_body()
-		content += "<div class=\"contentblock\"><h1>{}</h1>{}</div>\n".format(
-			self.title, main_body)
+		parts.append("<div class=\"contentblock\"><h1>{}</h1>{}</div>\n".format(
+			self.title, main_body))
 		# Build the main citation content block
 		main_citations = self.build_default_citeblock()
 		if main_citations:
-			content += "<div class=\"contentblock citeblock\">{}</div>\n".format(
-				main_citations)
+			parts.append("<div class=\"contentblock citeblock\">{}</div>\n".format(
+				main_citations))
 		# Build any addendum content blocks
 		for addendum in self.addendums:
 			add_body = addendum.build_default_article_body()
-			content += "<div class=\"contentblock\">{}</div>\n".format(add_body)
+			parts.append("<div class=\"contentblock\">{}</div>\n".format(add_body))
 			add_citations = addendum.build_default_citeblock()
 			if add_citations:
-				content += "<div class=\"contentblock\">{}</div>\n".format(
-					add_citations)
+				parts.append("<div class=\"contentblock\">{}</div>\n".format(
+					add_citations))
 		# Build the prev/next block
 		prev_next = self.build_prev_next_block(
 			self.prev_article, self.next_article)
 		if prev_next:
-			content += "<div class=\"contentblock citeblock\">{}</div>\n".format(
-				prev_next)
-		return content
+			parts.append("<div class=\"contentblock citeblock\">{}</div>\n".format(
+				prev_next))
+		return "".join(parts)
 
 	def build_default_article_body(self):
 		"""
 		Formats citations into the article text and returns the article body.
 		"""
 		format_map = {
-			"c"+str(c.id) : c.format("<a {article.link_class} "\
-				"href=\"{article.title_filesafe}.html\">{text}</a>")
+			"c{}".format(c.id) : "<a {0.article.link_class} "\
+				"href=\"{0.article.title_filesafe}.html\">{0.text}</a>".format(c)
 			for c in self.citations
 		}
-		return self.content.format(**format_map)
+		return self.content.format_map(format_map)
 
 	def build_default_citeblock(self):
 		"""
@@ -272,26 +286,32 @@ class LexiconArticle:
 		content.
 		"""
 		content = ""
-		# Citations
-		cites_titles = set()
-		cites_links = []
-		for citation in sorted(self.citations, key=lambda c: (utils.titlesort(c.target), c.id)):
-			if citation.target not in cites_titles:
-				cites_titles.add(citation.target)
-				cites_links.append(
-					citation.format(
-						"<a {article.link_class} href=\"{article.title_filesafe}.html\">{article.title}</a>"))
+		# Citations, keeping only the first citation of each target so that
+		# only unique targets need to be sorted
+		first_cite_by_target = {}
+		for citation in self.citations:
+			if citation.target not in first_cite_by_target:
+				first_cite_by_target[citation.target] = citation
+		cites_links = [
+			citation.format(
+				"<a {article.link_class} href=\"{article.title_filesafe}.html\">{article.title}</a>")
+			for citation in sorted(
+				first_cite_by_target.values(),
+				key=attrgetter("article.title_sort", "id"))]
 		cites_str = " / ".join(cites_links)
 		if len(cites_str) > 0:
 			content += "<p>Citations: {}</p>\n".format(cites_str)
-		# Citedby
-		citedby_titles = set()
-		citedby_links = []
-		for article in sorted(self.citedby, key=lambda a: (utils.titlesort(a.title), a.turn)):
-			if article.title not in citedby_titles:
-				citedby_titles.add(article.title)
-				citedby_links.append(
-					"<a {0.link_class} href=\"{0.title_filesafe}.html\">{0.title}</a>".format(article))
+		# Citedby, keeping only the earliest article under each title
+		first_citer_by_title = {}
+		for article in self.citedby:
+			first = first_citer_by_title.get(article.title)
+			if first is None or article.turn < first.turn:
+				first_citer_by_title[article.title] = article
+		citedby_links = [
+			"<a {0.link_class} href=\"{0.title_filesafe}.html\">{0.title}</a>".format(article)
+			for article in sorted(
+				first_citer_by_title.values(),
+				key=attrgetter("title_sort", "turn"))]
 		citedby_str = " / ".join(citedby_links)
 		if len(citedby_str) > 0:
 			content += "<p>Cited by: {}</p>\n".format(citedby_str)
@@ -1,12 +1,18 @@
 # Standard library imports
+import itertools	# For grouping articles
 import os		# For reading directories
 import re		# For parsing lex content
+from collections import defaultdict
+from operator import attrgetter
 
 # Application imports
 import utils
 from article import LexiconArticle
 from statistics import LexiconStatistics
 
+# Write buffer size for built pages
+OUTPUT_BUFFER_SIZE = 1 << 20
+
 
 class LexiconPage:
 	"""
@@ -20,17 +26,35 @@ class LexiconPage:
 		if page is not None:
 			self.skeleton = page.skeleton
 			self.kwargs = dict(page.kwargs)
+		# The skeleton split around {content}, made on first write
+		self._halves = None
 
 	def add_kwargs(self, **kwargs):
 		self.kwargs.update(kwargs)
 
 	def format(self, **kwargs):
+		return self.skeleton.format_map({**self.kwargs, **kwargs})
+
+	def write(self, f, content, **kwargs):
+		"""
+		Writes the page to a file open in binary mode, encoded as UTF-8. The
+		content is written between the formatted halves of the skeleton instead
+		of being formatted into one page-sized string.
+		"""
+		if self._halves is None:
+			self._halves = self.skeleton.partition("{content}")
+		head, sep, tail = self._halves
+		if not sep:
+			f.write(self.format(content=content, **kwargs).encode("utf-8"))
+			return
 		total_kwargs = {**self.kwargs, **kwargs}
-		return self.skeleton.format(**total_kwargs)
+		f.write(head.format_map(total_kwargs).encode("utf-8"))
+		f.write(content.encode("utf-8"))
+		f.write(tail.format_map(total_kwargs).encode("utf-8"))
 
 def article_matches_index(index_type, pattern, article):
 	if index_type == "char":
-		return utils.titlesort(article.title)[0].upper() in pattern.upper()
+		return article.title_sort[0].upper() in pattern.upper()
 	if index_type == "prefix":
 		return article.title.startswith(pattern)
 	if index_type == "etc":
@@ -41,25 +65,25 @@ def build_contents_page(config, page, articles):
 	"""
 	Builds the full HTML of the contents page.
 	"""
-	content = "<div class=\"contentblock\">"
+	parts = ["<div class=\"contentblock\">"]
 
 	# Head the contents page with counts of written and phantom articles
-	phantom_count = len([article for article in articles if article.player is None])
+	phantom_count = sum(1 for article in articles if article.player is None)
 	if phantom_count == 0:
-		content += "<p>There are <b>{0}</b> entries in this lexicon.</p>\n".format(len(articles))
+		parts.append("<p>There are <b>{0}</b> entries in this lexicon.</p>\n".format(len(articles)))
 	else:
-		content += "<p>There are <b>{0}</b> entries, <b>{1}</b> written and <b>{2}</b> phantom.</p>\n".format(
-			len(articles), len(articles) - phantom_count, phantom_count)
+		parts.append("<p>There are <b>{0}</b> entries, <b>{1}</b> written and <b>{2}</b> phantom.</p>\n".format(
+			len(articles), len(articles) - phantom_count, phantom_count))
 
-	# Prepare article links
-	link_by_title = {article.title : "<a href=\"../article/{1}.html\"{2}>{0}</a>".format(
+	# Prepare article list items, which appear once in each sort order
+	item_by_title = {article.title : "<li><a href=\"../article/{1}.html\"{2}>{0}</a></li>\n".format(
 			article.title, article.title_filesafe,
 			" class=\"phantom\"" if article.player is None else "")
 			for article in articles}
 
 	# Determine index order
 	indices = config['INDEX_LIST'].split("\n")
-	index_by_pri = {}
+	index_by_pri = defaultdict(list)
 	index_list_order = []
 	for index in indices:
 		match = re.match(r"([^[:]+)(\[([-\d]+)\])?:(.+)", index)
@@ -70,8 +94,6 @@ def build_contents_page(config, page, articles):
 			pri = int(pri_s) if pri_s else 0
 		except:
 			raise TypeError("Could not parse index pri '{}' in '{}'".format(pri_s, index))
-		if pri not in index_by_pri:
-			index_by_pri[pri] = []
 		index_by_pri[pri].append((index_type, pattern))
 		index_list_order.append(pattern)
 
@@ -79,83 +101,102 @@ def build_contents_page(config, page, articles):
 	articles_by_index = {pattern: [] for pattern in index_list_order}
 	titlesort_order = sorted(
 		articles,
-		key=lambda a: utils.titlesort(a.title))
+		key=attrgetter("title_sort"))
+	# Indices are tried in descending pri, then in list order
+	match_order = [
+		(index_type, pattern)
+		for pri, pri_indices in sorted(index_by_pri.items(), reverse=True)
+		for index_type, pattern in pri_indices]
+	# Char and etc indices only look at the first letter, so for each letter
+	# keep just the prefix indices ahead of the first other index it falls in
+	candidates_by_letter = {}
 	for article in titlesort_order:
-		# Find the first index that matches
-		matched = False
-		for pri, indices in sorted(index_by_pri.items(), reverse=True):
-			for index_type, pattern in indices:
-				# Try to match the index
-				if article_matches_index(index_type, pattern, article):
-					articles_by_index[pattern].append(article)
-					matched = True
-				# Break out once a match is found
-				if matched:
+		letter = article.title_sort[0].upper()
+		if letter not in candidates_by_letter:
+			candidates = []
+			for index_type, pattern in match_order:
+				if index_type == "prefix":
+					candidates.append((index_type, pattern))
+				elif article_matches_index(index_type, pattern, article):
+					candidates.append((index_type, pattern))
 					break
-			if matched:
+			candidates_by_letter[letter] = candidates
+		# Find the first index that matches
+		for index_type, pattern in candidates_by_letter[letter]:
+			if article_matches_index(index_type, pattern, article):
+				articles_by_index[pattern].append(article)
 				break
-		if not matched:
+		else:
 			raise KeyError("No index matched article '{}'".format(article.title))
 
 	# Write index order div
-	content += utils.load_resource("contents.html")
-	content += "<div id=\"index-order\" style=\"display:{}\">\n<ul>\n".format(
-		"block" if config["DEFAULT_SORT"] == "index" else "none")
+	parts.append(utils.load_resource("contents.html"))
+	parts.append("<div id=\"index-order\" style=\"display:{}\">\n<ul>\n".format(
+		"block" if config["DEFAULT_SORT"] == "index" else "none"))
 	for pattern in index_list_order:
 		# Write the index header
-		content += "<h3>{0}</h3>\n".format(pattern)
+		parts.append("<h3>{0}</h3>\n".format(pattern))
 		# Write all matches articles
-		for article in articles_by_index[pattern]:
-			content += "<li>{}</li>\n".format(link_by_title[article.title])
-	content += "</ul>\n</div>\n"
+		parts.extend(
+			item_by_title[article.title]
+			for article in articles_by_index[pattern])
+	parts.append("</ul>\n</div>\n")
 
 	# Write turn order div
-	content += "<div id=\"turn-order\" style=\"display:{}\">\n<ul>\n".format(
-		"block" if config["DEFAULT_SORT"] == "turn" else "none")
+	parts.append("<div id=\"turn-order\" style=\"display:{}\">\n<ul>\n".format(
+		"block" if config["DEFAULT_SORT"] == "turn" else "none"))
 	turn_numbers = [article.turn for article in articles if article.player is not None]
 	first_turn, last_turn = min(turn_numbers), max(turn_numbers)
 	turn_order = sorted(
 		articles,
-		key=lambda a: (a.turn, utils.titlesort(a.title)))
-	check_off = list(turn_order)
+		key=attrgetter("turn", "title_sort"))
+	# Group the articles by turn in one pass over the turn-sorted list
+	articles_by_turn = {
+		turn_num: list(turn_articles)
+		for turn_num, turn_articles in itertools.groupby(turn_order, key=attrgetter("turn"))}
 	for turn_num in range(first_turn, last_turn + 1):
-		content += "<h3>Turn {0}</h3>\n".format(turn_num)
-		for article in turn_order:
-			if article.turn == turn_num:
-				check_off.remove(article)
-				content += "<li>{}</li>\n".format(link_by_title[article.title])
-	if len(check_off) > 0:
-		content += "<h3>Unwritten</h3>\n"
-		for article in check_off:
-			content += "<li>{}</li>\n".format(link_by_title[article.title])
-	content += "</ul>\n</div>\n"
+		parts.append("<h3>Turn {0}</h3>\n".format(turn_num))
+		parts.extend(
+			item_by_title[article.title]
+			for article in articles_by_turn.get(turn_num, []))
+	unwritten = [
+		article
+		for turn_num, turn_articles in articles_by_turn.items()
+		if not first_turn <= turn_num <= last_turn
+		for article in turn_articles]
+	if len(unwritten) > 0:
+		parts.append("<h3>Unwritten</h3>\n")
+		parts.extend(
+			item_by_title[article.title]
+			for article in unwritten)
+	parts.append("</ul>\n</div>\n")
 
 	# Write by-player div
-	content += "<div id=\"player-order\" style=\"display:{}\">\n<ul>\n".format(
-		"block" if config["DEFAULT_SORT"] == "player" else "none")
-	articles_by_player = {}
+	parts.append("<div id=\"player-order\" style=\"display:{}\">\n<ul>\n".format(
+		"block" if config["DEFAULT_SORT"] == "player" else "none"))
+	articles_by_player = defaultdict(list)
 	extant_phantoms = False
 	for article in turn_order:
 		if article.player is not None:
-			if article.player not in articles_by_player:
-				articles_by_player[article.player] = []
 			articles_by_player[article.player].append(article)
 		else:
 			extant_phantoms = True
 	for player, player_articles in sorted(articles_by_player.items()):
-		content += "<h3>{0}</h3>\n".format(player)
-		for article in player_articles:
-			content += "<li>{}</li>\n".format(link_by_title[article.title])
+		parts.append("<h3>{0}</h3>\n".format(player))
+		parts.extend(
+			item_by_title[article.title]
+			for article in player_articles)
 	if extant_phantoms:
-		content += "<h3>Unwritten</h3>\n"
-		for article in titlesort_order:
-			if article.player is None:
-				content += "<li>{}</li>\n".format(link_by_title[article.title])
-	content += "</ul>\n</div>\n"
-
-	content += "</div>\n"
+		parts.append("<h3>Unwritten</h3>\n")
+		parts.extend(
+			item_by_title[article.title]
+			for article in titlesort_order
+			if article.player is None)
+	parts.append("</ul>\n</div>\n")
+
+	parts.append("</div>\n")
 	# Fill in the page skeleton
-	return page.format(title="Index", content=content)
+	return page.format(title="Index", content="".join(parts))
 
 def build_rules_page(page):
 	"""
@@ -178,17 +219,17 @@ def build_session_page(page, config):
 	Builds the full HTML of the session page.
 	"""
 	# Misc links
-	content =  '<div class="contentblock misclinks"><table><tr>\n'
-	content += '<td><a href="../editor.html">Editor</a></td>\n'
+	parts = ['<div class="contentblock misclinks"><table><tr>\n']
+	parts.append('<td><a href="../editor.html">Editor</a></td>\n')
 	if config['SEARCHABLE_FILE']:
-		content += '<td><a href="../{}">Compiled</a></td>\n'.format(config['SEARCHABLE_FILE'].strip())
-	content += '</tr></table></div>\n'
+		parts.append('<td><a href="../{}">Compiled</a></td>\n'.format(config['SEARCHABLE_FILE'].strip()))
+	parts.append('</tr></table></div>\n')
 	# Session content
-	content += "<div class=\"contentblock\">{}</div>".format(config["SESSION_PAGE"])
+	parts.append("<div class=\"contentblock\">{}</div>".format(config["SESSION_PAGE"]))
 
-	return page.format(title="Session", content=content)
+	return page.format(title="Session", content="".join(parts))
 
-def build_statistics_page(config, page, articles):
+def build_statistics_page(config, page, articles, cite_map):
 	# Read the config file for which stats to publish.
 	lines = config['STATISTICS'].split("\n")
 	stats = []
@@ -198,7 +239,7 @@ def build_statistics_page(config, page, articles):
 			stats.append("stat_" + stat)
 
 	# Create all the stats blocks.
-	lexicon_stats = LexiconStatistics(articles)
+	lexicon_stats = LexiconStatistics(articles, cite_map)
 	stats_blocks = []
 	for stat in stats:
 		if hasattr(lexicon_stats, stat):
@@ -210,6 +251,19 @@ def build_statistics_page(config, page, articles):
 	# Fill in the entry skeleton
 	return page.format(title="Statistics", content=content)
 
+def build_cite_map(articles):
+	"""
+	Maps the title of each written page to the set of titles cited by the
+	page's article and addendums.
+	"""
+	return {
+		article.title: {
+			citation.target
+			for written in [article] + article.addendums
+			for citation in written.citations}
+		for article in articles
+		if article.player is not None}
+
 def build_graphviz_file(cite_map):
 	"""
 	Builds a citation graph in dot format for Graphviz.
@@ -218,74 +272,78 @@ def build_graphviz_file(cite_map):
 	result.append("digraph G {\n")
 	# Node labeling
 	written_entries = list(cite_map.keys())
-	phantom_entries = set([title for cites in cite_map.values() for title in cites if title not in written_entries])
-	node_labels = [title[:20] for title in written_entries + list(phantom_entries)]
-	node_names = [hash(i) for i in node_labels]
-	for i in range(len(node_labels)):
-		result.append("{} [label=\"{}\"];\n".format(node_names[i], node_labels[i]))
+	phantom_entries = set().union(*cite_map.values()) - set(written_entries)
+	# Number the nodes by title so node names are stable across runs and
+	# titles that share a truncated label don't collide
+	node_ids = {
+		title: i
+		for i, title in enumerate(written_entries + sorted(phantom_entries))}
+	for title, node_id in node_ids.items():
+		label = title[:20].replace("\\", "\\\\").replace("\"", "\\\"")
+		result.append("n{} [label=\"{}\"];\n".format(node_id, label))
 	# Edges
 	for citer in written_entries:
-		for cited in cite_map[citer]:
-			result.append("{}->{};\n".format(hash(citer[:20]), hash(cited[:20])))
+		for cited in sorted(cite_map[citer]):
+			result.append("n{}->n{};\n".format(node_ids[citer], node_ids[cited]))
 	# Return result
 	result.append("overlap=false;\n}\n")
 	return "".join(result)#"…"
 
 def build_compiled_page(articles, config):
 	"""
-	Builds a page compiling all articles in the Lexicon.
+	Builds a page compiling all articles in the Lexicon. Yields the page in
+	chunks so it can be written out without holding it all in memory.
 	"""
 	articles = sorted(
 		articles,
-		key=lambda a: (utils.titlesort(a.title)))
+		key=attrgetter("title_sort"))
 
 	# Write the header
-	content = "<html><head><title>{}</title>"\
+	yield ("<html><head><title>{}</title>"\
 		"<style>span.signature {{ text-align: right; }} "\
 		"sup {{ vertical-align: top; font-size: 0.6em; }} "\
 		"u {{ text-decoration-color: #888888; }}</style>"\
-		"</head><body>\n".format(config["LEXICON_TITLE"])
+		"</head><body>\n".format(config["LEXICON_TITLE"]))
 
 	# Write each article
 	for article in articles:
 		# Article title
-		content += "<div style=\"page-break-inside:avoid;\"><h2>{0.title}</h2>".format(article)
+		yield "<div style=\"page-break-inside:avoid;\"><h2>{0.title}</h2>".format(article)
 
 		# Article content
 		format_map = {
-			"c"+str(c.id) : c.format("<u>{text}</u><sup>{id}</sup>")
+			"c{}".format(c.id) : "<u>{0.text}</u><sup>{0.id}</sup>".format(c)
 			for c in article.citations
 		}
-		article_content = article.content.format(**format_map)
+		article_content = article.content.format_map(format_map)
 		article_content = article_content.replace("</p>", "</p></div>", 1)
-		content += article_content
+		yield article_content
 
 		# Article citations
 		cite_list = "<br>".join(
-			c.format("{id}. {target}")
+			"{0.id}. {0.target}".format(c)
 			for c in article.citations)
 		cite_block = "<p>{}</p>".format(cite_list)
-		content += cite_block
+		yield cite_block
 
 		# Addendums
 		for addendum in article.addendums:
 			# Addendum content
 			format_map = {
-				"c"+str(c.id) : c.format("<u>{text}</u><sup>{id}</sup>")
+				"c{}".format(c.id) : "<u>{0.text}</u><sup>{0.id}</sup>".format(c)
 				for c in addendum.citations
 			}
-			article_content = addendum.content.format(**format_map)
-			content += article_content
+			article_content = addendum.content.format_map(format_map)
+			yield article_content
 
 			# Addendum citations
 			cite_list = "<br>".join(
-				c.format("{id}. {target}")
+				"{0.id}. {0.target}".format(c)
 				for c in addendum.citations)
 			cite_block = "<p>{}</p>".format(cite_list)
-			content += cite_block
+			yield cite_block
 
-	content += "</body></html>"
-	return content
+	yield "</body></html>"
 
 def latex_from_markdown(raw_content):
 	content = ""
@@ -351,7 +409,7 @@ def latex_from_directory(directory):
 		"\\begin{document}\n"\
 		"\n"
 
-	for title in sorted(articles.keys(), key=lambda t: utils.titlesort(t)):
+	for title in sorted(articles.keys(), key=utils.titlesort):
 		under_title = articles[title]
 		turns = sorted(under_title.keys())
 		latex = under_title[turns[0]]
@@ -388,6 +446,14 @@ def latex_from_directory(directory):
 
 	return content
 
+def write_article_page(article, page, article_dir):
+	"""
+	Renders and writes the page of the given article into article_dir.
+	"""
+	path = os.path.join(article_dir, article.title_filesafe + ".html")
+	with open(path, "wb", buffering=OUTPUT_BUFFER_SIZE) as f:
+		page.write(f, article.build_default_content(), title=article.title)
+
 def parse_sort_type(sort):
 	if sort in "?byindex":
 		return "?byindex"
@@ -414,88 +480,99 @@ def build_all(path_prefix, lexicon_name):
 	# Parse the written articles
 	articles = LexiconArticle.parse_from_directory(os.path.join(lex_path, "src"))
 	# Once they've been populated, the articles list has the titles of all articles
-	# Sort this by turn before title so prev/next links run in turn order
-	articles = sorted(
-		LexiconArticle.interlink(articles, config),
-		key=lambda a: (a.turn, utils.titlesort(a.title)))
+	# interlink returns them sorted by turn before title, the order the
+	# prev/next links run in
+	articles = LexiconArticle.interlink(articles, config)
+	# The citation graph the statistics are computed from
+	cite_map = build_cite_map(articles)
 
 	def pathto(*els):
 		return os.path.join(lex_path, *els)
 
+	def open_output(*els):
+		# Pages are encoded up front and written as bytes, buffered whole so
+		# each output file takes few write calls
+		return open(pathto(*els), "wb", buffering=OUTPUT_BUFFER_SIZE)
+
 	# Write the redirect page
 	print("Writing redirect page...")
-	with open(pathto("index.html"), "w", encoding="utf8", newline='') as f:
+	with open_output("index.html") as f:
 		f.write(utils.load_resource("redirect.html").format(
-			lexicon=config["LEXICON_TITLE"], sort=parse_sort_type(config["DEFAULT_SORT"])))
+			lexicon=config["LEXICON_TITLE"], sort=parse_sort_type(config["DEFAULT_SORT"])).encode("utf-8"))
 
 	# Write the article pages
 	print("Deleting old article pages...")
-	for filename in os.listdir(pathto("article")):
-		if filename[-5:] == ".html":
-			os.remove(pathto("article", filename))
+	# Pages that are about to be rewritten are truncated when they're opened,
+	# so only pages that no longer have an article need to be removed
+	article_filenames = {article.title_filesafe + ".html" for article in articles}
+	with os.scandir(pathto("article")) as entries:
+		for entry in entries:
+			if (entry.name.endswith(".html")
+					and entry.name not in article_filenames
+					and entry.is_file()):
+				os.remove(entry.path)
 	print("Writing article pages...")
-	l = len(articles)
-	for idx in range(l):
-		article = articles[idx]
-		with open(pathto("article", article.title_filesafe + ".html"), "w", encoding="utf-8", newline='') as f:
-			content = article.build_default_content()
-			article_html = page.format(
-				title = article.title,
-				content = content)
-			f.write(article_html)
+	for article in articles:
+		write_article_page(article, page, pathto("article"))
 		print("    Wrote " + article.title)
 
 	# Write default pages
 	print("Writing default pages...")
-	with open(pathto("contents", "index.html"), "w", encoding="utf-8", newline='') as f:
-		f.write(build_contents_page(config, page, articles))
+	with open_output("contents", "index.html") as f:
+		f.write(build_contents_page(config, page, articles).encode("utf-8"))
 	print("    Wrote Contents")
-	with open(pathto("rules", "index.html"), "w", encoding="utf-8", newline='') as f:
-		f.write(build_rules_page(page))
+	with open_output("rules", "index.html") as f:
+		f.write(build_rules_page(page).encode("utf-8"))
 	print("    Wrote Rules")
-	with open(pathto("formatting", "index.html"), "w", encoding="utf-8", newline='') as f:
-		f.write(build_formatting_page(page))
+	with open_output("formatting", "index.html") as f:
+		f.write(build_formatting_page(page).encode("utf-8"))
 	print("    Wrote Formatting")
-	with open(pathto("session", "index.html"), "w", encoding="utf-8", newline='') as f:
-		f.write(build_session_page(page, config))
+	with open_output("session", "index.html") as f:
+		f.write(build_session_page(page, config).encode("utf-8"))
 	print("    Wrote Session")
-	with open(pathto("statistics", "index.html"), "w", encoding="utf-8", newline='') as f:
-		f.write(build_statistics_page(config, page, articles))
+	with open_output("statistics", "index.html") as f:
+		f.write(build_statistics_page(config, page, articles, cite_map).encode("utf-8"))
 	print("    Wrote Statistics")
 
 	# Write auxiliary pages
 	if "SEARCHABLE_FILE" in config and config["SEARCHABLE_FILE"]:
-		with open(pathto(config["SEARCHABLE_FILE"]), "w", encoding="utf-8", newline='') as f:
-			f.write(build_compiled_page(articles, config))
+		with open_output(config["SEARCHABLE_FILE"]) as f:
+			f.writelines(
+				chunk.encode("utf-8")
+				for chunk in build_compiled_page(articles, config))
 		print("    Wrote compiled page to " + config["SEARCHABLE_FILE"])
 
-	with open(pathto("editor.html"), "w", encoding="utf-8", newline='') as f:
+	with open_output("editor.html") as f:
 		editor = utils.load_resource("editor.html")
-		writtenArticles = ""
-		phantomArticles = ""
+		writtenArticles = []
+		phantomArticles = []
+		self_citations = []
 		for article in articles:
+			# Note authors citing themselves while the articles are walked
+			for written in [article] + article.addendums:
+				self_citations.extend(
+					(written, citation)
+					for citation in written.citations
+					if written.player == citation.article.player)
 			citedby = {'"' + citer.player + '"' for citer in article.citedby}
 			if article.player is None:
-				phantomArticles += "{{title: \"{0}\", citedby: [{1}]}},".format(
+				phantomArticles.append("{{title: \"{0}\", citedby: [{1}]}},".format(
 					article.title.replace("\"", "\\\""),
-					",".join(sorted(citedby)))
+					",".join(sorted(citedby))))
 			else:
-				writtenArticles += "{{title: \"{0}\", author: \"{1.player}\"}},".format(
-					article.title.replace("\"", "\\\""), article)
+				writtenArticles.append("{{title: \"{0}\", author: \"{1.player}\"}},".format(
+					article.title.replace("\"", "\\\""), article))
 		nextTurn = 0
 		if articles:
-			nextTurn = max([article.turn for article in articles if article.player is not None]) + 1
-		editor = editor.replace("//writtenArticles", writtenArticles)
-		editor = editor.replace("//phantomArticles", phantomArticles)
+			nextTurn = max(article.turn for article in articles if article.player is not None) + 1
+		editor = editor.replace("//writtenArticles", "".join(writtenArticles))
+		editor = editor.replace("//phantomArticles", "".join(phantomArticles))
 		editor = editor.replace("TURNNUMBER", str(nextTurn))
-		f.write(editor)
+		f.write(editor.encode("utf-8"))
 
 	# Check that authors aren't citing themselves
 	print("Running citation checks...")
-	for parent in articles:
-		for article in [parent] + parent.addendums:
-			for citation in article.citations:
-				if article.player == citation.article.player:
-					print("    {2}: {0} cites {1}".format(article.title, citation.target, article.player))
+	for article, citation in self_citations:
+		print("    {2}: {0} cites {1}".format(article.title, citation.target, article.player))
 
 	print()
@@ -1,35 +1,83 @@
+# Standard library imports
+from collections import Counter, defaultdict
+from operator import itemgetter
+
 # Third party imports
 try:
-	import networkx # For pagerank analytics
-	NETWORKX_ENABLED = True
+	import numpy # For pagerank analytics
+	NUMPY_ENABLED = True
 except:
-	NETWORKX_ENABLED = False
+	NUMPY_ENABLED = False
 
 # Application imports
 from utils import titlesort
 
 
-def reverse_statistics_dict(stats, reverse=True):
+def reverse_statistics_dict(stats, reverse=True, sort_keys=None):
 	"""
 	Transforms a dictionary mapping titles to a value into a list of values
 	and lists of titles. The list is sorted by the value, and the titles are
-	sorted alphabetically.
+	sorted alphabetically. If sort_keys is given, it must map every title to
+	its precomputed titlesort.
 	"""
-	rev = {}
+	sort_key = titlesort if sort_keys is None else sort_keys.__getitem__
+	rev = defaultdict(list)
 	for key, value in stats.items():
-		if value not in rev:
-			rev[value] = []
 		rev[value].append(key)
-	for key, value in rev.items():
-		rev[key] = sorted(value, key=lambda t: titlesort(t))
-	return sorted(rev.items(), key=lambda x:x[0], reverse=reverse)
+	return sorted(
+		((value, sorted(keys, key=sort_key)) for value, keys in rev.items()),
+		key=itemgetter(0), reverse=reverse)
+
+
+def pagerank(edges, alpha=0.85, tol=1.0e-6, max_iter=100):
+	"""
+	Computes pagerank on the directed graph with the given edges by power
+	iteration over a sparse transition matrix. Returns a dictionary mapping
+	each node that appears in an edge to its pagerank.
+	"""
+	# Number the nodes in the order they first appear.
+	index_by_node = {}
+	rows, cols = [], []
+	for u, v in edges:
+		rows.append(index_by_node.setdefault(u, len(index_by_node)))
+		cols.append(index_by_node.setdefault(v, len(index_by_node)))
+	n = len(index_by_node)
+	if n == 0:
+		return {}
+
+	# Link each citing page to the page it cites, as parallel arrays of link
+	# sources and targets. Repeated edges are collapsed into a single link.
+	links = numpy.unique(
+		numpy.array(rows, dtype=numpy.int64) * n + numpy.array(cols, dtype=numpy.int64))
+	sources, indices = numpy.divmod(links, n)
+	out_degree = numpy.bincount(sources, minlength=n)
+	# Weight links into transition probabilities. Nodes with no outgoing
+	# links distribute their rank evenly.
+	data = 1.0 / out_degree[sources]
+	dangling = out_degree == 0
+
+	# Start from a uniform rank, which is also where teleports land.
+	p = numpy.full(n, 1.0 / n)
+	x = p
+
+	# Iterate until the total change in rank falls under the tolerance.
+	for _ in range(max_iter):
+		x_last = x
+		# Each link carries its share of its source's rank to its target.
+		flow = numpy.bincount(indices, weights=data * x[sources], minlength=n)
+		x = alpha * (flow + x[dangling].sum() * p) + (1 - alpha) * p
+		if numpy.abs(x - x_last).sum() < n * tol:
+			break
+	return {node: float(x[i]) for node, i in index_by_node.items()}
 
 
 def itemize(stats_list):
 	"""
 	Formats a list consisting of tuples of ranks and lists of ranked items.
 	"""
-	return map(lambda x: "{0} &ndash; {1}".format(x[0], "; ".join(x[1])), stats_list)
+	return (
+		"{0} &ndash; {1}".format(rank, "; ".join(titles))
+		for rank, titles in stats_list)
 
 
 class LexiconStatistics():
@@ -45,43 +93,77 @@ class LexiconStatistics():
 	the same title.
 	"""
 
-	def __init__(self, articles):
+	def __init__(self, articles, cite_map):
+		"""
+		Collects the data the statistics are computed from. cite_map maps the
+		title of each written page to the set of titles it cites.
+		"""
 		self.articles = articles
 		self.min_turn = 0
 		self.max_turn = 0
 		self.players = set()
 		self.title_to_article = {}
 		self.title_to_page = {}
+		# Titlesorts of every page title and disambiguated article title.
+		self.title_to_sortkey = {}
+		# The page citation graph, as a list of unique edges and as the
+		# number of pages each page cites and is cited by.
+		self.citation_edges = []
+		self.title_to_cited_count = Counter()
+		self.title_to_citer_count = Counter()
+		# Citations made by each player's authored articles (not pages), and
+		# citations made to each player's authored pages (not articles).
+		self.player_to_cites_made = Counter()
+		self.player_to_cites_received = Counter()
 		self.stat_block = "<div class=\"contentblock\"><u>{0}</u><br>{1}</div>\n"
-		# Pagerank may not be computable if networkx isn't installed.
+		# Pagerank may not be computable if numpy isn't installed.
 		self.title_to_pagerank = None
+		# Word counts are computed on first use and shared between stats.
+		self.title_to_word_count = None
 
 		for main_article in articles:
 			page_title = main_article.title
 			self.title_to_page[page_title] = [main_article]
 			self.title_to_page[page_title].extend(main_article.addendums)
+			self.title_to_sortkey[page_title] = main_article.title_sort
+			if main_article.player is not None:
+				self.player_to_cites_received[main_article.player] += len(main_article.citedby)
 			for article in self.title_to_page[page_title]:
 				# Disambiguate articles by appending turn number to the title
 				key = "{0.title} (T{0.turn})".format(article)
 				self.title_to_article[key] = article
+				self.title_to_sortkey[key] = titlesort(key)
 				if article.player is not None:
 					# Phantoms have turn MAXINT by convention
 					self.min_turn = min(self.min_turn, article.turn)
 					self.max_turn = max(self.max_turn, article.turn)
 					self.players.add(article.player)
+					self.player_to_cites_made[article.player] += len(article.citations)
+
+		# Count the citation graph from the cite map. Each page's citations
+		# are sorted so the edge order doesn't depend on set ordering.
+		for page_title, cited_titles in cite_map.items():
+			self.title_to_cited_count[page_title] = len(cited_titles)
+			for cited_title in sorted(cited_titles):
+				self.citation_edges.append((page_title, cited_title))
+				self.title_to_citer_count[cited_title] += 1
+
+	def _format_stat_block(self, title, items):
+		"""Formats a statistics block listing the given items."""
+		return self.stat_block.format(title, "<br>".join(items))
+
+	def _populate_word_counts(self):
+		"""Collects the word count of each article (not page) once."""
+		if self.title_to_word_count is None:
+			self.title_to_word_count = {
+				article_title: article.word_count
+				for article_title, article in self.title_to_article.items()}
 
 	def _try_populate_pagerank(self):
-		"""Computes pagerank if networkx is imported."""
-		if NETWORKX_ENABLED and self.title_to_pagerank is None:
-			# Create a citation graph linking page titles.
-			G = networkx.Graph()
-			for page_title, articles in self.title_to_page.items():
-				for article in articles:
-					for citation in article.citations:
-						G.add_edge(page_title, citation.target)
-
+		"""Computes pagerank if numpy is imported."""
+		if NUMPY_ENABLED and self.title_to_pagerank is None:
 			# Compute pagerank on the page citation graph.
-			self.title_to_pagerank = networkx.pagerank(G)
+			self.title_to_pagerank = pagerank(self.citation_edges)
 			# Any article with no links in the citation graph have no pagerank.
 			# Assign these pagerank 0 to avoid key errors or missing pages in
 			# the stats.
@@ -94,125 +176,90 @@ class LexiconStatistics():
 		self._try_populate_pagerank()
 
 		if not self.title_to_pagerank:
-			# If networkx was not successfully imported, skip the pagerank.
-			top_ranked_items = "networkx must be installed to compute pageranks."
+			# If numpy was not successfully imported, skip the pagerank. The
+			# message is a single item so the join doesn't split it up.
+			top_ranked_items = ["numpy must be installed to compute pageranks."]
 
 		else:
 			# Get the top ten articles by pagerank.
-			top_pageranks = reverse_statistics_dict(self.title_to_pagerank)[:10]
+			top_pageranks = reverse_statistics_dict(
+				self.title_to_pagerank, sort_keys=self.title_to_sortkey)[:10]
 			# Replace the pageranks with ordinals.
-			top_ranked = enumerate(map(lambda x: x[1], top_pageranks), start=1)
+			top_ranked = enumerate((titles for _, titles in top_pageranks), start=1)
 			# Format the ranks into strings.
 			top_ranked_items = itemize(top_ranked)
 
 		# Format the statistics block.
-		return self.stat_block.format(
-			"Top 10 articles by page rank:",
-			"<br>".join(top_ranked_items))
+		return self._format_stat_block("Top 10 articles by page rank:", top_ranked_items)
 
 	def stat_most_citations_made(self):
 		"""Computes the top 3 ranks for citations made FROM a page."""
-		# Determine which pages are cited from all articles on a page.
-		pages_cited = {
-			page_title: set()
-			for page_title in self.title_to_page.keys()}
-		for page_title, articles in self.title_to_page.items():
-			for article in articles:
-				for citation in article.citations:
-					pages_cited[page_title].add(citation.target)
 		# Compute the number of unique articles cited by a page.
-		for page_title, cite_titles in pages_cited.items():
-			pages_cited[page_title] = len(cite_titles)
+		pages_cited = {
+			page_title: self.title_to_cited_count[page_title]
+			for page_title in self.title_to_page}
 
 		# Reverse and itemize the citation counts.
-		top_citations = reverse_statistics_dict(pages_cited)[:3]
+		top_citations = reverse_statistics_dict(
+			pages_cited, sort_keys=self.title_to_sortkey)[:3]
 		top_citations_items = itemize(top_citations)
 
 		# Format the statistics block.
-		return self.stat_block.format(
-			"Cited the most pages:",
-			"<br>".join(top_citations_items))
+		return self._format_stat_block("Cited the most pages:", top_citations_items)
 
 	def stat_most_citations_to(self):
 		"""Computes the top 3 ranks for citations made TO a page."""
-		# Determine which pages cite a page.
-		pages_cited_by = {
-			page_title: set()
-			for page_title in self.title_to_page.keys()}
-		for page_title, articles in self.title_to_page.items():
-			for article in articles:
-				for citation in article.citations:
-					pages_cited_by[citation.target].add(page_title)
 		# Compute the number of unique articles that cite a page.
-		for page_title, cite_titles in pages_cited_by.items():
-			pages_cited_by[page_title] = len(cite_titles)
+		pages_cited_by = {
+			page_title: self.title_to_citer_count[page_title]
+			for page_title in self.title_to_page}
 
 		# Reverse and itemize the citation counts.
-		top_cited = reverse_statistics_dict(pages_cited_by)[:3]
+		top_cited = reverse_statistics_dict(
+			pages_cited_by, sort_keys=self.title_to_sortkey)[:3]
 		top_cited_items = itemize(top_cited)
 
 		# Format the statistics block.
-		return self.stat_block.format(
-			"Cited by the most pages:",
-			"<br>".join(top_cited_items))
+		return self._format_stat_block("Cited by the most pages:", top_cited_items)
 
 	def stat_longest_article(self):
 		"""Computes the top 3 longest articles."""
-		# Compute the length of each article (not page).
-		title_to_article_length = {}
-		for article_title, article in self.title_to_article.items():
-			# Write all citation aliases into the article text to accurately
-			# compute word count as written.
-			format_map = {
-				"c"+str(c.id): c.text
-				for c in article.citations
-			}
-			plain_content = article.content.format(**format_map)
-			word_count = len(plain_content.split())
-			title_to_article_length[article_title] = word_count
+		# Get the length of each article (not page).
+		self._populate_word_counts()
 
 		# Reverse and itemize the article lengths.
-		top_length = reverse_statistics_dict(title_to_article_length)[:3]
+		top_length = reverse_statistics_dict(
+			self.title_to_word_count, sort_keys=self.title_to_sortkey)[:3]
 		top_length_items = itemize(top_length)
 
 		# Format the statistics block.
-		return self.stat_block.format(
-			"Longest articles:",
-			"<br>".join(top_length_items))
+		return self._format_stat_block("Longest articles:", top_length_items)
 
 	def stat_cumulative_wordcount(self):
 		"""Computes the cumulative word count of the lexicon."""
-		# Initialize all extant turns to 0.
-		turn_to_cumulative_wordcount = {
-			turn_num: 0
-			for turn_num in range(self.min_turn, self.max_turn + 1)
-		}
+		# Tally the words written in each turn.
+		self._populate_word_counts()
+		turn_to_wordcount = defaultdict(int)
 		for article_title, article in self.title_to_article.items():
-			# Compute each article's word count.
-			format_map = {
-				"c"+str(c.id): c.text
-				for c in article.citations
-			}
-			plain_content = article.content.format(**format_map)
-			word_count = len(plain_content.split())
-			# Add the word count to each turn the article exists in.
-			for turn_num in range(self.min_turn, self.max_turn + 1):
-				if article.turn <= turn_num:
-					turn_to_cumulative_wordcount[turn_num] += word_count
+			turn_to_wordcount[article.turn] += self.title_to_word_count[article_title]
+		# Accumulate the tallies over all extant turns.
+		turn_to_cumulative_wordcount = {}
+		running_wordcount = 0
+		for turn_num in range(self.min_turn, self.max_turn + 1):
+			running_wordcount += turn_to_wordcount[turn_num]
+			turn_to_cumulative_wordcount[turn_num] = running_wordcount
 
 		# Format the statistics block.
-		len_list = [(str(k), [str(v)]) for k,v in turn_to_cumulative_wordcount.items()]
-		return self.stat_block.format(
-			"Aggregate word count by turn:",
-			"<br>".join(itemize(len_list)))
+		len_list = ((str(k), [str(v)]) for k,v in turn_to_cumulative_wordcount.items())
+		return self._format_stat_block("Aggregate word count by turn:", itemize(len_list))
 
 	def stat_player_pagerank(self):
 		"""Computes each player's share of the lexicon's pagerank scores."""
 		self._try_populate_pagerank()
 
 		if not self.title_to_pagerank:
-			# If networkx was not successfully imported, skip the pagerank.
-			player_rank_items = "networkx must be installed to compute pageranks."
+			# If numpy was not successfully imported, skip the pagerank.
+			player_rank_items = ["numpy must be installed to compute pageranks."]
 
 		else:
 			player_to_pagerank = {
@@ -232,78 +279,66 @@ class LexiconStatistics():
 			player_rank_items = itemize(player_rank)
 
 		# Format the statistics block.
-		return self.stat_block.format(
-			"Player aggregate page rank:",
-			"<br>".join(player_rank_items))
+		return self._format_stat_block("Player aggregate page rank:", player_rank_items)
 
 	def stat_player_citations_made(self):
 		"""Computes the total number of citations made BY each player."""
 		pages_cited_by_player = {
-			player: 0
+			player: self.player_to_cites_made[player]
 			for player in self.players}
-		# Add the number of citations from each authored article (not page).
-		for article_title, article in self.title_to_article.items():
-			if article.player is not None:
-				pages_cited_by_player[article.player] += len(article.citations)
 
 		# Reverse and itemize the counts.
 		player_cites_made_ranks = reverse_statistics_dict(pages_cited_by_player)
 		player_cites_made_items = itemize(player_cites_made_ranks)
 
 		# Format the statistics block.
-		return self.stat_block.format(
-			"Citations made by player:",
-			"<br>".join(player_cites_made_items))
+		return self._format_stat_block("Citations made by player:", player_cites_made_items)
 
 	def stat_player_citations_to(self):
 		"""Computes the total number of citations made TO each player's
 		authored pages."""
 		pages_cited_by_by_player = {
-			player: 0
+			player: self.player_to_cites_received[player]
 			for player in self.players}
-		# Add the number of citations made to each page (not article).
-		for page_title, articles in self.title_to_page.items():
-			page_author = articles[0].player
-			if page_author is not None:
-				pages_cited_by_by_player[page_author] += len(articles[0].citedby)
 
 		# Reverse and itemize the results.
 		cited_times_ranked = reverse_statistics_dict(pages_cited_by_by_player)
 		cited_times_items = itemize(cited_times_ranked)
 
 		# Format the statistics block.
-		return self.stat_block.format(
-			"Citations made to article by player:",
-			"<br>".join(cited_times_items))
+		return self._format_stat_block("Citations made to article by player:", cited_times_items)
 
 	def stat_bottom_pagerank(self):
 		"""Computes the bottom 10 pages by pagerank."""
 		self._try_populate_pagerank()
 
 		if not self.title_to_pagerank:
-			# If networkx was not successfully imported, skip the pagerank.
-			bot_ranked_items = "networkx must be installed to compute pageranks."
+			# If numpy was not successfully imported, skip the pagerank.
+			bot_ranked_items = ["numpy must be installed to compute pageranks."]
 
 		else:
-			# Phantoms have no pagerank, because they don't cite anything.
-			exclude = [
+			# Phantoms are cited, so they get a pagerank, but they are left out of
+			# the bottom ranking because nobody has written them.
+			exclude = {
 				a.title
 				for a in self.articles
-				if a.player is None]
+				if a.player is None}
 			rank_by_written_only = {
 				k:v
 				for k,v in self.title_to_pagerank.items()
 				if k not in exclude}
 			
 			# Reverse, enumerate, and itemize the bottom 10 by pagerank.
-			pageranks = reverse_statistics_dict(rank_by_written_only)
-			bot_ranked = list(enumerate(map(lambda x: x[1], pageranks), start=1))[-10:]
+			pageranks = reverse_statistics_dict(
+				rank_by_written_only, sort_keys=self.title_to_sortkey)
+			bot_pageranks = pageranks[-10:]
+			bot_ranked = enumerate(
+				(titles for _, titles in bot_pageranks),
+				start=len(pageranks) - len(bot_pageranks) + 1)
 			bot_ranked_items = itemize(bot_ranked)
 
 		# Format the statistics block.
-		return self.stat_block.format(
-			"Bottom 10 articles by page rank:",
-			"<br>".join(bot_ranked_items))
+		return self._format_stat_block("Bottom 10 articles by page rank:", bot_ranked_items)
 
 	def stat_undercited(self):
 		"""Computes which articles have 0 or 1 citations made to them."""
@@ -311,7 +346,6 @@ class LexiconStatistics():
 			page_title: len(articles[0].citedby)
 			for page_title, articles in self.title_to_page.items()
 			if len(articles[0].citedby) < 2}
-		undercited_items = itemize(reverse_statistics_dict(undercited))
-		return self.stat_block.format(
-			"Undercited articles:",
-			"<br>".join(undercited_items))
+		undercited_items = itemize(reverse_statistics_dict(
+			undercited, sort_keys=self.title_to_sortkey))
+		return self._format_stat_block("Undercited articles:", undercited_items)
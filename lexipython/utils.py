@@ -1,6 +1,7 @@
 import os
 import re
 import io
+from functools import lru_cache
 from urllib import parse
 import pkg_resources
 
@@ -13,21 +14,27 @@ def titlecase(s):
 	s = s.strip()
 	return s[:1].capitalize() + s[1:]
 
+@lru_cache(maxsize=None)
 def titleescape(s):
 	"""
 	Makes an article title filename-safe.
 	"""
 	s = s.strip()
 	s = re.sub(r"\s+", '_', s)  # Replace whitespace with _
+	# Plain ASCII letters, digits, and _ pass through quoting unchanged
+	if s.isascii() and s.replace('_', '').isalnum():
+		return s[:64]
 	s = re.sub(r"~", '-', s)    # parse.quote doesn't catch ~
 	s = parse.quote(s)          # Encode all other characters
 	s = re.sub(r"%", "", s)     # Strip encoding %s
 	s = s[:64]                  # Limit to 64 characters
 	return s
 
+@lru_cache(maxsize=None)
 def titlesort(s):
 	"""
-	Reduces titles down for sorting.
+	Reduces titles down for sorting. Cached, since the same titles are
+	sorted many times over a build.
 	"""
 	s = s.lower()
 	if s.startswith("the "): return s[4:]
@@ -37,36 +44,36 @@ def titlesort(s):
 
 # Load functions
 
-def load_resource(filename, cache={}):
+@lru_cache(maxsize=None)
+def load_resource(filename):
 	"""Loads files from the resources directory with caching."""
-	if filename not in cache:
-		binary = pkg_resources.resource_string("resources", filename)
-		unistr = binary.decode("utf-8")
-		cache[filename] = unistr
-	return cache[filename]
+	binary = pkg_resources.resource_string("resources", filename)
+	return binary.decode("utf-8")
+
+# Opens a config value definition
+CONFIG_OPEN_RE = re.compile(r">>>([^>]+)>>>\s+")
 
 def parse_config_file(f):
 	"""Parses a Lexipython config file."""
 	config = {}
-	line = f.readline()
-	while line:
+	# Read the whole file at once and walk its lines in memory
+	lines = iter(f.readlines())
+	for line in lines:
 		# Skim lines until a value definition begins
-		conf_match = re.match(r">>>([^>]+)>>>\s+", line)
+		conf_match = CONFIG_OPEN_RE.match(line)
 		if not conf_match:
-			line = f.readline()
 			continue
 		# Accumulate the conf value until the value ends
 		conf = conf_match.group(1)
-		conf_value = ""
-		line = f.readline()
-		conf_match = re.match(r"<<<{0}<<<\s+".format(conf), line)
-		while line and not conf_match:
-			conf_value += line
-			line = f.readline()
-			conf_match = re.match(r"<<<{0}<<<\s+".format(conf), line)
-		if not line:
+		conf_close_re = re.compile(r"<<<{0}<<<\s+".format(re.escape(conf)))
+		conf_lines = []
+		for line in lines:
+			if conf_close_re.match(line):
+				break
+			conf_lines.append(line)
+		else:
 			raise EOFError("Reached EOF while reading config value {}".format(conf))
-		config[conf] = conf_value.strip()
+		config[conf] = "".join(conf_lines).strip()
 	return config
 
 def load_config(name):